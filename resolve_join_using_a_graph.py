@@ -1,12 +1,17 @@
-from sqlalchemy import create_engine
+import functools
+import os
+
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.orm import relationship, sessionmaker
-import networkx as nx
-import matplotlib.pyplot as plt
+from sqlalchemy.orm import joinedload, relationship, sessionmaker
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
 
 # create a in memory sqlite database
-engine = create_engine('sqlite:///:memory:', echo=False)
+# set the environment variable AUTO_JOIN_ECHO to log the emitted SQL
+engine = create_engine('sqlite:///:memory:', echo=bool(os.environ.get('AUTO_JOIN_ECHO')), query_cache_size=1200)
 
 # create the base for declarative class mapping
 Base = declarative_base()
@@ -67,29 +72,37 @@ Session = sessionmaker(bind=engine)
 session = Session()
 
 # add examples to the database
-for example in examples:
-    # create catalog and add if it doesn't exist yet
-    catalog = session.query(Catalog).filter(Catalog.name == example['catalog']).first()
-
-    if not catalog:
-        catalog = Catalog(name=example['catalog'])
-        session.add(catalog)
-        session.commit()
-
-    # create author and add if it doesn't exist already
-    author = session.query(Author).filter(Author.name == example['author']).first()
-
-    if not author:
-        author = Author(name=example['author'])
-        session.add(author)
-        session.commit()
-
-    # create a book referenced to author and catalog and add
-    book = Book(title=example['title'], author_id=author.id, catalog_id=catalog.id)
-    session.add(book)
-    session.commit()
-
-for book in session.query(Book).all():
+# the examples are staged in a temporary table, catalogs, authors and books are then inserted with one
+# INSERT ... SELECT per table which resolves the foreign keys inside the database.
+# everything runs within a single transaction which is committed at the end of the block
+with session.begin():
+    session.execute(text('CREATE TEMPORARY TABLE staging (catalog VARCHAR, author VARCHAR, title VARCHAR)'))
+    session.execute(text('INSERT INTO staging (catalog, author, title) VALUES (:catalog, :author, :title)'), examples)
+
+    # create catalogs and authors if they don't exist yet
+    session.execute(text(
+        'INSERT INTO catalogs (name) '
+        'SELECT DISTINCT s.catalog FROM staging s '
+        'WHERE NOT EXISTS (SELECT 1 FROM catalogs c WHERE c.name = s.catalog)'
+    ))
+    session.execute(text(
+        'INSERT INTO authors (name) '
+        'SELECT DISTINCT s.author FROM staging s '
+        'WHERE NOT EXISTS (SELECT 1 FROM authors a WHERE a.name = s.author)'
+    ))
+
+    # create the books referenced to author and catalog
+    session.execute(text(
+        'INSERT INTO books (title, author_id, catalog_id) '
+        'SELECT s.title, a.id, c.id FROM staging s '
+        'JOIN authors a ON a.name = s.author '
+        'JOIN catalogs c ON c.name = s.catalog'
+    ))
+
+    session.execute(text('DROP TABLE staging'))
+
+# load the catalog and author together with the books instead of one query per book
+for book in session.query(Book).options(joinedload(Book.author), joinedload(Book.catalog)).all():
     print(book.catalog, book.author, book.title)
 
 
@@ -99,22 +112,22 @@ The graph is then used to construct a joining path.
 """
 
 
-def create_graph(Base, plot=True):
+@functools.lru_cache(maxsize=8)
+def _build_graph(metadata_id, tables):
     """
-    Create a graph of the database. The nodes are the view tables and the edges are the relationship between the tables.
-    :param Base: declarative base of the database model
-    :param plot: if True the constructed graph will be plotted. Default=True
+    Build the graph of the database. The result is cached, so the graph of a schema is only constructed once.
+    The graph is a dict holding the table names, the adjacency of the tables as CSR arrays and the joins between them.
+    :param metadata_id: id of the metadata the tables belong to (part of the cache key)
+    :param tables: tuple of the sorted tables of the metadata
     """
-    G = nx.Graph()
+    # each table is a node and gets a consecutive index
+    nodes = [str(t.name) for t in tables]
+    index = {name: i for i, name in enumerate(nodes)}
 
-    # add nodes
-    for t in Base.metadata.sorted_tables:
-        # add the table name
-        G.add_node(str(t.name))
-
-    # iterate over each table and extract foreignkey relationships and add edge
-    for table in Base.metadata.sorted_tables:
-        table_name = str(t.name)
+    # iterate over each table and extract foreignkey relationships as edges
+    edge_attr = {}
+    for table in tables:
+        table_name = str(table.name)
 
         # iterate over each foreignkey
         for fk in table.foreign_keys:
@@ -125,50 +138,131 @@ def create_graph(Base, plot=True):
             # create a tuple storing the join relationship
             join_on = ((table_name, table_column), (fk_table, fk_column))
 
-            # add the edge to the graph
-            G.add_edge(table_name, fk_table, join_on=join_on)
+            # the graph is undirected, store the join for both directions
+            i, j = index[table_name], index[fk_table]
+            edge_attr[(i, j)] = join_on
+            edge_attr[(j, i)] = join_on
 
-    if plot:
-        plt.figure(figsize=(10, 10))
-        nx.draw(G, with_labels=True, font_weight='bold')
-        plt.show()
+    # lay out the edges as flat arrays in CSR order (sorted by source, then target)
+    # the neighbours of table i are neighbors[indptr[i]:indptr[i + 1]], the join of edge e is joins[e]
+    edge_keys = sorted(edge_attr)
+    neighbors = np.array([j for _, j in edge_keys], dtype=np.int32)
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+    np.cumsum(np.bincount([i for i, _ in edge_keys], minlength=len(nodes)), out=indptr[1:])
+    joins = [edge_attr[key] for key in edge_keys]
 
-    return G
+    # sparse adjacency matrix for scipy, sharing the index arrays
+    csr = csr_matrix((np.ones(len(joins)), neighbors, indptr), shape=(len(nodes), len(nodes)))
 
+    graph = {'nodes': nodes, 'index': index, 'indptr': indptr, 'neighbors': neighbors, 'joins': joins, 'csr': csr}
 
-def resolve_join(graph, table_start, table_end):
+    # precompute the joins between all pairs of connected tables
+    # the shortest paths from every table are calculated at once and can be reconstructed from the predecessors
+    _, predecessors = shortest_path(csr, directed=False, unweighted=True, return_predecessors=True)
+
+    plans = {}
+    for src in range(len(nodes)):
+        for dst in range(len(nodes)):
+            if src != dst and predecessors[src, dst] < 0:
+                # no path between the tables
+                continue
+
+            # walk back from the end to the start
+            path = [dst]
+            while path[-1] != src:
+                path.append(int(predecessors[src, path[-1]]))
+            path.reverse()
+
+            plans[(nodes[src], nodes[dst])] = _materialize_joins(path, graph)
+    graph['plans'] = plans
+
+    return graph
+
+
+def create_graph(Base, plot=False):
     """
-    Use the information provided within filters and the graph to infer which tables have to be joined and in which order.
+    Create a graph of the database. The nodes are the view tables and the edges are the relationship between the tables.
+    The graph is cached per metadata, calling this function again for the same schema returns the same graph.
+    :param Base: declarative base of the database model
+    :param plot: if True the constructed graph will be plotted. Default=False
+    """
+    graph = _build_graph(id(Base.metadata), tuple(Base.metadata.sorted_tables))
 
-    :param table: the table that you want to select from
-    :param filters: a dict with filters (only equal and "and" connected) {'region': ['DEU', 'FRA']}
+    if plot:
+        plot_graph(graph)
+
+    return graph
+
+
+def plot_graph(graph):
+    """
+    Plot the graph of the database.
+    :param graph: graph created by create_graph
     """
+    # networkx and matplotlib are only needed for plotting, importing them is expensive so it's done here
+    # instead of at module level
+    import matplotlib.pyplot as plt
+    import networkx as nx
 
-    # calculate the shortest path between the root table (select) and the filter table
-    path = nx.shortest_path(graph, table_start, table_end)
+    nodes = graph['nodes']
+    G = nx.Graph()
+    G.add_nodes_from(nodes)
+    G.add_edges_from(
+        (nodes[i], nodes[j])
+        for i in range(len(nodes))
+        for j in graph['neighbors'][graph['indptr'][i]:graph['indptr'][i + 1]]
+    )
 
-    # resolve the relationship between the tables
-    # extract information on which fields to join (edge attribute 'join_on')
-    joins = {}
+    plt.figure(figsize=(10, 10))
+    nx.draw(G, with_labels=True, font_weight='bold')
+    plt.show()
 
-    temp = []
-    for index, table in enumerate(path):
-        if index < len(path) - 1:
-            # information about the join is stored inside the edge of the graph
-            join_on = graph.edges[(table, path[index + 1])]['join_on']
 
-            # add a tuple (table_to_join, (table1, field1), (table2, field2))
-            # JOIN table_to_join ON table1.field1 == table2.field2
-            if path[index + 1] not in joins:
-                joins[path[index + 1]] = join_on
+def _materialize_joins(path, graph):
+    """
+    Resolve the relationship between the tables along a path.
+    :param path: list of table indices, e.g. the shortest path between two tables
+    :param graph: graph created by _build_graph
+    """
+    # extract information on which fields to join
+    # a shortest path visits every table only once, so there is exactly one join per edge of the path
+    joins = [None] * (len(path) - 1)
 
-    # convert the dictionar to a list of tuples
-    joins = [(table, *joins[table]) for table in joins]
+    for i in range(len(path) - 1):
+        # information about the join is stored per edge of the graph, find the edge within the neighbours of the table
+        start = graph['indptr'][path[i]]
+        edge = start + int(np.searchsorted(graph['neighbors'][start:graph['indptr'][path[i] + 1]], path[i + 1]))
+
+        # add a tuple (table_to_join, (table1, field1), (table2, field2))
+        # JOIN table_to_join ON table1.field1 == table2.field2
+        joins[i] = (graph['nodes'][path[i + 1]], *graph['joins'][edge])
 
     # return a list of joins
     return joins
 
-g = create_graph(Base, plot=True)
+
+def resolve_join(graph, table_start, table_end):
+    """
+    Use the information provided within filters and the graph to infer which tables have to be joined and in which order.
+    The joins between all pairs of tables are precomputed when the graph is built, so this is a lookup.
+
+    :param table: the table that you want to select from
+    :param filters: a dict with filters (only equal and "and" connected) {'region': ['DEU', 'FRA']}
+    """
+    plan = graph['plans'].get((table_start, table_end))
+
+    if plan is None:
+        # there is no plan if either table is unknown or there is no path between them
+        for table in (table_start, table_end):
+            if table not in graph['index']:
+                raise ValueError('Table {} is not in the graph'.format(table))
+        raise ValueError('No path between {} and {}'.format(table_start, table_end))
+
+    # return a copy so callers can't modify the cached plan
+    return list(plan)
+
+
+g = create_graph(Base)
 joins = resolve_join(g, 'authors', 'catalogs')
 
 print(joins)
\ No newline at end of file